@@ -3,22 +3,52 @@ import os
 import logging
 import hashlib
 import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import streamlit as st
 
 # 外部URLによるrequests呼び出しは行いません（requests等は使用しない）
 try:
-    import google.generativeai as genai
     from PIL import Image
-    _GENAI_AVAILABLE = True
+    _PIL_AVAILABLE = True
+except Exception:
+    _PIL_AVAILABLE = False
+
+try:
+    import google.generativeai as genai
+    from google.generativeai import client as genai_client
+    _GENAI_AVAILABLE = _PIL_AVAILABLE
 except Exception:
     # google.generativeai / Pillow が無ければローカル比較にフォールバック
     _GENAI_AVAILABLE = False
 
 logging.basicConfig(level=logging.INFO)
 
+# genai.configure はプロセス全体の設定を書き換えるため、設定〜クライアント確定までをこのロックで直列化する
+_GENAI_CONFIGURE_LOCK = threading.Lock()
+
 # デフォルトモデル名は環境変数で上書き可能
 GEMINI_MODEL_DEFAULT = os.environ.get("GEMINI_MODEL", "gemini-2.0")
 
+def _env_positive_int(name: str, default: int) -> int:
+    """環境変数を 1 以上の整数として読む（未設定・不正値なら default を使う）"""
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        logging.warning("%s=%r is not an integer; using %d", name, raw, default)
+        return default
+    return max(1, value)
+
+# 複数提出を採点するときの同時実行数の上限（API のクォータエラーを避けるため）。環境変数で上書き可能
+MAX_CONCURRENT_GRADINGS = _env_positive_int("GRADING_CONCURRENCY", 8)
+
+# Gemini にそのまま渡せる画像の MIME タイプ
+_GEMINI_IMAGE_MIME_TYPES = {"image/jpeg", "image/png", "image/webp"}
+
 PROMPT_TEMPLATE = """
 あなたは採点者です。以下の2つの画像（提出画像、模範解答画像）を比較して、点数(0-100) と簡潔な採点コメント（日本語）を JSON で返してください。
 JSON フィールド:
@@ -31,12 +61,37 @@ JSON フィールド:
 def _sha256(b: bytes):
     return hashlib.sha256(b).hexdigest() if b else None
 
-def resize_image_bytes(image_bytes: bytes, max_dim: int = 1024) -> bytes:
-    """Pillow を使って画像をリサイズ（渡された bytes を JPEG 化して返す）"""
+def _open_binary(src):
+    """bytes / バイナリのファイルライクオブジェクトを、先頭から読めるストリームとして返す"""
+    if isinstance(src, (bytes, bytearray)):
+        return io.BytesIO(src)
+    src.seek(0)
+    return src
+
+def _read_bytes(src):
+    """bytes / バイナリのファイルライクオブジェクトの内容を bytes で返す"""
+    if isinstance(src, (bytes, bytearray)):
+        return bytes(src)
+    src.seek(0)
+    return src.read()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def resize_image_bytes(image_bytes, max_dim: int = 1024) -> bytes:
+    """
+    Pillow を使って画像をリサイズ（JPEG 化した bytes を返す。同じ入力の結果はキャッシュされる）。
+    image_bytes には bytes のほか、アップロードファイル等のバイナリのファイルライクオブジェクトも渡せる。
+    """
     if not image_bytes:
         return image_bytes
     try:
-        img = Image.open(io.BytesIO(image_bytes))
+        img = Image.open(_open_binary(image_bytes))
+        # 既に max_dim 以内の RGB JPEG ならデコード・再エンコードせずそのまま返す（ここまではヘッダの解析のみ）
+        # EXIF 付きは再エンコード経路に回す（回転タグの扱いを揃え、位置情報等のメタデータを外部に送らないため）
+        if img.format == "JPEG" and img.mode == "RGB" and max(img.size) <= max_dim and not img.getexif():
+            return _read_bytes(image_bytes)
+        # JPEG はデコード時に DCT 領域で縮小させる（max_dim 以上は保ったまま。JPEG 以外では何もしない）
+        img.draft("RGB", (max_dim, max_dim))
+        img.load()
         if img.mode != "RGB":
             img = img.convert("RGB")
         w, h = img.size
@@ -47,13 +102,40 @@ def resize_image_bytes(image_bytes: bytes, max_dim: int = 1024) -> bytes:
             else:
                 new_h = max_dim
                 new_w = int(w * (max_dim / h))
-            img = img.resize((new_w, new_h), Image.LANCZOS)
+            # 縮小率が大きい場合は reduce() で整数倍に間引いてから LANCZOS で仕上げる
+            img = img.resize((new_w, new_h), Image.LANCZOS, reducing_gap=3.0)
         buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=90)
+        # optimize / progressive / subsampling はこの画質での Pillow の既定値（ベースライン・4:2:0）を明示しているだけ。
+        # 実質的な変更は画質 90→85 で、出力が小さくなり送信量が減る
+        img.save(buf, format="JPEG", quality=85, optimize=False, progressive=False, subsampling=2)
         return buf.getvalue()
     except Exception:
         logging.exception("resize_image_bytes failed")
-        return image_bytes
+        return _read_bytes(image_bytes)
+
+def _dhash(image_bytes: bytes) -> int:
+    """9x8 に縮小したグレースケール画像の横方向の明暗差から 64bit の差分ハッシュ (dHash) を計算する"""
+    img = Image.open(io.BytesIO(image_bytes))
+    # JPEG はデコード時点で 1/8 まで縮小させ、9x8 への縮小コストをほぼゼロにする
+    img.draft("L", (9, 8))
+    img = img.convert("L").resize((9, 8), Image.BOX)
+    arr = np.asarray(img, dtype=np.int16)
+    diff = arr[:, 1:] > arr[:, :-1]
+    return int.from_bytes(np.packbits(diff).tobytes(), "big")
+
+def _dhash_similarity(a: bytes, b: bytes) -> float:
+    """2枚の画像の dHash のハミング距離から見た目の類似度 (0-100) を返す"""
+    distance = bin(_dhash(a) ^ _dhash(b)).count("1")
+    return round((1 - distance / 64) * 100.0, 2)
+
+def _byte_similarity(a: bytes, b: bytes) -> float:
+    """先頭から同じ位置のバイトが一致する割合 (0-100) を返す"""
+    minlen = min(len(a), len(b))
+    if minlen == 0:
+        return 0.0
+    # Python ループではなく NumPy のベクトル比較で一致バイト数を数える
+    matches = int(np.count_nonzero(np.frombuffer(a, dtype=np.uint8, count=minlen) == np.frombuffer(b, dtype=np.uint8, count=minlen)))
+    return round(matches / minlen * 100.0, 2)
 
 def _local_mock_grade(image_bytes=None, image_filename=None, model_image_bytes=None, model_image_filename=None):
     """外部呼び出しをしないローカル簡易採点"""
@@ -65,21 +147,23 @@ def _local_mock_grade(image_bytes=None, image_filename=None, model_image_bytes=N
     submission_info = info(image_bytes, image_filename)
     model_info = info(model_image_bytes, model_image_filename)
 
-    byte_similarity = None
+    similarity = None
+    similarity_method = None
     if image_bytes and model_image_bytes:
-        a = image_bytes
-        b = model_image_bytes
-        minlen = min(len(a), len(b))
-        if minlen == 0:
-            byte_similarity = 0.0
-        else:
-            matches = sum(1 for i in range(minlen) if a[i] == b[i])
-            byte_similarity = round(matches / minlen * 100.0, 2)
+        try:
+            # 見た目の類似度 (dHash) で比較する。再エンコードされただけの同じ画像もほぼ 100 になる
+            similarity = _dhash_similarity(image_bytes, model_image_bytes)
+            similarity_method = "dhash"
+        except Exception:
+            # 画像としてデコードできない場合はバイト単位の一致率にフォールバック
+            logging.exception("dhash comparison failed")
+            similarity = _byte_similarity(image_bytes, model_image_bytes)
+            similarity_method = "bytes"
 
     # 非常に簡易なスコアリング（参考用）
     score = None
-    if byte_similarity is not None:
-        score = int(byte_similarity) if byte_similarity is not None else 0
+    if similarity is not None:
+        score = int(similarity)
         # clamp 0-100
         score = max(0, min(100, score))
     else:
@@ -90,11 +174,75 @@ def _local_mock_grade(image_bytes=None, image_filename=None, model_image_bytes=N
         "grading_type": "local_mock",
         "submission": submission_info,
         "model": model_info,
-        "byte_similarity_percent": byte_similarity,
+        "similarity_percent": similarity,
+        "similarity_method": similarity_method,
         "score": score,
         "comment": "外部APIには接続していません。ローカルの簡易比較結果です。実運用では google.generativeai を導入してモデルで採点してください。"
     }
 
+def _image_part(image_bytes: bytes):
+    """
+    SDK に渡す画像パートを作る（MIME タイプはヘッダから判定し、対応形式ならピクセルはデコードしない）。
+    Gemini が受け付けない形式（BMP / TIFF / GIF 等）は PNG に変換して渡す。
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    mime_type = Image.MIME.get(img.format)
+    if mime_type in _GEMINI_IMAGE_MIME_TYPES:
+        return {"mime_type": mime_type, "data": image_bytes}
+    if img.mode not in ("RGB", "RGBA", "L"):
+        img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return {"mime_type": "image/png", "data": buf.getvalue()}
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _get_gemini_model(api_key: str, model_name: str):
+    """
+    APIキー・モデル名ごとに GenerativeModel を1つだけ作り、Streamlit の再実行をまたいで使い回す。
+    genai.configure はクライアントを作り直すため、毎回呼ぶと接続・TLS ハンドシェイクもやり直しになる。
+    GenerativeModel は初回の generate_content 時に「その時点の」既定クライアントを拾うため、
+    ロック内でクライアントまで確定させ、他セッションの configure で別のキーに紐付かないようにする。
+    """
+    with _GENAI_CONFIGURE_LOCK:
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(model_name)
+        model._client = genai_client.get_default_generative_client()
+    return model
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=64)
+def _generate_grading(api_key: str, model_name: str, submission_bytes: bytes, model_bytes: bytes):
+    """
+    SDK でモデルに採点を依頼し、結果を返す。
+    同じ (画像, 模範画像, モデル名) の組み合わせは 1 時間キャッシュし、再実行で API を再課金しない。
+    失敗時は例外を送出する（st.cache_data は例外をキャッシュしないため、エラーは次回再試行される）。
+    """
+    model = _get_gemini_model(api_key, model_name or GEMINI_MODEL_DEFAULT)
+
+    # 画像は PIL.Image にデコードせず、エンコード済みの bytes のまま渡す（SDK 側での再エンコードも不要になる）
+    imgs = []
+    if submission_bytes:
+        imgs.append(_image_part(submission_bytes))
+    if model_bytes:
+        imgs.append(_image_part(model_bytes))
+
+    prompt = PROMPT_TEMPLATE
+    # SDK 呼び出し: prompt と画像群を渡して生成
+    # 注意: 実行環境の SDK 実装に依存するため、例外処理で安全にフォールバックする
+    resp = model.generate_content([prompt] + imgs)
+    # SDK の戻りは実装依存。可能な限りテキストを取得する
+    cand = getattr(resp, "_result", None)
+    if cand and getattr(cand, "candidates", None):
+        text = cand.candidates[0].content.parts[0].text.strip()
+        # 返されるものが JSON 文字列ならパースを試みる
+        try:
+            import json
+            parsed = json.loads(text)
+            return parsed
+        except Exception:
+            # パースできない場合は自由テキストを結果として返す
+            return {"raw_text": text}
+    raise RuntimeError("モデルから有効な応答が得られませんでした")
+
 def _call_gemini_local_sdk(api_key: str, model_name: str, submission_bytes: bytes, model_bytes: bytes):
     """
     google.generativeai SDK を利用してローカルからモデル呼び出しを行うラッパー。
@@ -103,57 +251,67 @@ def _call_gemini_local_sdk(api_key: str, model_name: str, submission_bytes: byte
     if not _GENAI_AVAILABLE:
         return {"error": "google.generativeai が利用できません（未インストール）"}
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(model_name) if model_name else genai.GenerativeModel(GEMINI_MODEL_DEFAULT)
-
-        # 画像は PIL.Image にして渡す（SDKが画像を受け取れる場合）
-        imgs = []
-        if submission_bytes:
-            imgs.append(Image.open(io.BytesIO(submission_bytes)))
-        if model_bytes:
-            imgs.append(Image.open(io.BytesIO(model_bytes)))
-
-        prompt = PROMPT_TEMPLATE
-        # SDK 呼び出し: prompt と画像群を渡して生成
-        # 注意: 実行環境の SDK 実装に依存するため、例外処理で安全にフォールバックする
-        resp = model.generate_content([prompt] + imgs)
-        # SDK の戻りは実装依存。可能な限りテキストを取得する
-        cand = getattr(resp, "_result", None)
-        if cand and getattr(cand, "candidates", None):
-            text = cand.candidates[0].content.parts[0].text.strip()
-            # 返されるものが JSON 文字列ならパースを試みる
-            try:
-                import json
-                parsed = json.loads(text)
-                return parsed
-            except Exception:
-                # パースできない場合は自由テキストを結果として返す
-                return {"raw_text": text}
-        return {"error": "モデルから有効な応答が得られませんでした"}
+        return _generate_grading(api_key, model_name, submission_bytes, model_bytes)
     except Exception as e:
         logging.exception("gemini sdk call failed")
         return {"error": f"gemini sdk error: {e}"}
 
+def _grade_resized(api_key, sub_bytes, image_filename, mod_bytes, model_image_filename, model_name):
+    """リサイズ済みの画像を「SDK経由」または「ローカル比較」で採点する"""
+    try:
+        if _GENAI_AVAILABLE and api_key:
+            return _call_gemini_local_sdk(api_key=api_key, model_name=(model_name or GEMINI_MODEL_DEFAULT), submission_bytes=sub_bytes, model_bytes=mod_bytes)
+        else:
+            # SDKが無い or APIキー未指定の時はローカル採点で返す
+            return _local_mock_grade(image_bytes=sub_bytes, image_filename=image_filename, model_image_bytes=mod_bytes, model_image_filename=model_image_filename)
+    except Exception as e:
+        logging.exception("grade_submission failed")
+        return {"error": str(e)}
+
 def grade_submission(api_key=None, submission_text=None, image_bytes=None, image_filename=None, model_image_bytes=None, model_image_filename=None, model_name=None, timeout=10):
     """
     外部URLをrequestsで叩かずに「SDK経由」または「ローカル比較」で採点する関数。
     - google.generativeai が利用可能なら SDK 経由でモデルに採点を依頼する（SDK内部での通信は許容）。
     - 利用できない場合はローカルの簡易採点を返す。
+    画像は bytes またはバイナリのファイルライクオブジェクト（st.file_uploader の戻り値など）で受け取る。
     """
     # 画像はリサイズしてから送る（サイズが大きすぎると失敗することがあるため）
     try:
-        sub_bytes = resize_image_bytes(image_bytes) if image_bytes else None
-        mod_bytes = resize_image_bytes(model_image_bytes) if model_image_bytes else None
-
-        if _GENAI_AVAILABLE and api_key:
-            return _call_gemini_local_sdk(api_key=api_key, model_name=(model_name or GEMINI_MODEL_DEFAULT), submission_bytes=sub_bytes, model_bytes=mod_bytes)
+        if image_bytes and model_image_bytes:
+            # 2枚のリサイズは独立しているので並行に実行する（デコード・エンコード中は Pillow が GIL を解放する）
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                sub_future = executor.submit(resize_image_bytes, image_bytes)
+                mod_future = executor.submit(resize_image_bytes, model_image_bytes)
+                sub_bytes = sub_future.result()
+                mod_bytes = mod_future.result()
         else:
-            # SDKが無い or APIキー未指定の時はローカル採点で返す
-            return _local_mock_grade(image_bytes=sub_bytes, image_filename=image_filename, model_image_bytes=mod_bytes, model_image_filename=model_image_filename)
+            sub_bytes = resize_image_bytes(image_bytes) if image_bytes else None
+            mod_bytes = resize_image_bytes(model_image_bytes) if model_image_bytes else None
     except Exception as e:
         logging.exception("grade_submission failed")
         return {"error": str(e)}
 
+    return _grade_resized(api_key, sub_bytes, image_filename, mod_bytes, model_image_filename, model_name)
+
+def _grade_with_shared_model(api_key, uploaded_image, model_future, model_image_filename, model_name):
+    """
+    複数提出の採点用: 提出画像をリサイズし、共有の模範解答のリサイズ完了を待ってから採点する。
+    模範解答は model_future（同じ executor に先に投入したリサイズ）から受け取るため、スレッド間で同じファイルを読まない。
+    """
+    sub_bytes = resize_image_bytes(uploaded_image)
+    mod_bytes = model_future.result() if model_future else None
+    return _grade_resized(api_key, sub_bytes, uploaded_image.name, mod_bytes, model_image_filename, model_name)
+
+def _render_result(placeholder, result):
+    """採点結果を指定の表示枠に描画する"""
+    with placeholder.container():
+        if isinstance(result, dict) and result.get("error"):
+            st.error(f"エラー: {result['error']}")
+            st.json(result)
+        else:
+            st.success("採点完了")
+            st.json(result)
+
 def main():
     st.title("自動採点アプリ（URL直接呼び出しなし）")
     st.write("外部URLをrequestsで直接叩かずに、google.generativeai SDK を使うか、SDKが無い場合はローカル比較で採点します。")
@@ -161,36 +319,39 @@ def main():
     api_key = st.text_input("GEMINI API キー（SDK利用時にのみ必要）", type="password")
     model_name = st.text_input("モデル名（例: gemini-2.0-flash）", value=GEMINI_MODEL_DEFAULT)
 
-    uploaded_image = st.file_uploader("提出画像をアップロード（png/jpg 等）", type=["png","jpg","jpeg","bmp","tiff","gif"])
-    image_bytes = None
-    image_filename = None
-    if uploaded_image:
-        image_bytes = uploaded_image.read()
-        image_filename = uploaded_image.name
-        st.image(image_bytes, caption=image_filename, use_column_width=True)
+    # アップロードファイルは .read() で bytes に複製せず、ファイルライクのまま後段に渡す
+    uploaded_images = st.file_uploader("提出画像をアップロード（png/jpg 等・複数可）", type=["png","jpg","jpeg","bmp","tiff","gif"], accept_multiple_files=True)
+    for uploaded_image in uploaded_images or []:
+        st.image(uploaded_image, caption=uploaded_image.name, use_column_width=True)
 
     uploaded_model = st.file_uploader("模範解答画像をアップロード（任意）", type=["png","jpg","jpeg","bmp","tiff","gif"], key="model_uploader")
-    model_image_bytes = None
     model_image_filename = None
     if uploaded_model:
-        model_image_bytes = uploaded_model.read()
         model_image_filename = uploaded_model.name
-        st.image(model_image_bytes, caption="模範: " + model_image_filename, use_column_width=True)
+        st.image(uploaded_model, caption="模範: " + model_image_filename, use_column_width=True)
 
     if st.button("採点を実行"):
-        if not image_bytes:
+        if not uploaded_images:
             st.error("提出画像をアップロードしてください。")
             return
 
-        with st.spinner("採点中..."):
-            result = grade_submission(api_key=api_key or None, submission_text=None, image_bytes=image_bytes, image_filename=image_filename, model_image_bytes=model_image_bytes, model_image_filename=model_image_filename, model_name=(model_name or None))
+        # 提出ごとに結果の表示枠を用意し、採点が終わったものから順に埋める
+        placeholders = []
+        for uploaded_image in uploaded_images:
+            st.subheader(uploaded_image.name)
+            placeholders.append(st.empty())
 
-        if isinstance(result, dict) and result.get("error"):
-            st.error(f"エラー: {result['error']}")
-            st.json(result)
-        else:
-            st.success("採点完了")
-            st.json(result)
+        with st.spinner(f"採点中...（{len(uploaded_images)} 件）"):
+            # 各採点は API の応答待ちが大半なので、上限付きのスレッドで同時に投げる
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_GRADINGS) as executor:
+                # 模範解答は全提出で共有するため一度だけリサイズする。最初に投入し、提出側のリサイズと並行させる
+                model_future = executor.submit(resize_image_bytes, uploaded_model) if uploaded_model else None
+                futures = {
+                    executor.submit(_grade_with_shared_model, api_key or None, uploaded_image, model_future, model_image_filename, model_name or None): i
+                    for i, uploaded_image in enumerate(uploaded_images)
+                }
+                for future in as_completed(futures):
+                    _render_result(placeholders[futures[future]], future.result())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -39,6 +39,7 @@ from IPython.display import display, HTML
 from google.colab import files, userdata
 from flask import Flask, request, render_template_string, redirect, url_for
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 import base64
 from pyngrok import ngrok
 import time
@@ -280,14 +281,11 @@ def resize_and_preprocess_image(image_bytes, max_dim=1024):
     最大辺がmax_dimを超える場合、アスペクト比を維持して縮小する。
     """
     try:
-        # PILで画像を開く
-        img_pil = Image.open(io.BytesIO(image_bytes))
-        if img_pil.mode != 'RGB':
-            img_pil = img_pil.convert('RGB')
-
-        # PILイメージをOpenCV形式に変換
-        img_cv = np.array(img_pil)
-        img_cv = cv2.cvtColor(img_cv, cv2.COLOR_RGB2BGR)
+        # OpenCVで直接BGR画像としてデコード (PIL経由の配列コピーとRGB⇔BGR変換を省く)
+        # EXIFの回転情報はPILのフォールバック処理と同様に適用しない
+        img_cv = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if img_cv is None:
+            raise ValueError("OpenCVで画像をデコードできませんでした")
 
         # 現在のスクリプトは発表用のため画像補正処理を無効化
         # # 1. ノイズ除去: ガウシアンブラー
@@ -308,11 +306,11 @@ def resize_and_preprocess_image(image_bytes, max_dim=1024):
                 new_width = int(width * (max_dim / height))
             img_cv = cv2.resize(img_cv, (new_width, new_height), interpolation=cv2.INTER_LANCZOS4)
 
-        # OpenCVイメージをPIL形式に戻し、バイトデータとして返す
-        img_pil_resized = Image.fromarray(cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB))
-        buffered = io.BytesIO()
-        img_pil_resized.save(buffered, format="JPEG")
-        return buffered.getvalue()
+        # OpenCVのままJPEGにエンコードし、バイトデータとして返す (画質はPILの既定値75に合わせる)
+        ok, encoded = cv2.imencode('.jpg', img_cv, [cv2.IMWRITE_JPEG_QUALITY, 75])
+        if not ok:
+            raise ValueError("OpenCVで画像をエンコードできませんでした")
+        return encoded.tobytes()
     except Exception as e:
         logging.error(f"Error during image resizing/pre-processing: {e}")
         # 前処理に失敗した場合、リサイズのみ試みる
@@ -427,14 +425,18 @@ def process_image_background(image_bytes):
         image_pil = Image.open(io.BytesIO(image_bytes))
 
         # ステップ1: 異なるプロンプトで2つの書き起こし候補を生成
-        global_processing_status = "Geminiモデルが手書き文字を解析中です (候補1/2)..."
-        response1_text = get_gemini_response(image_bytes, PROMPT_BASE)
+        # 2つの呼び出しは互いに独立しているため、スレッドで同時に投げて待ち時間を重ねる
+        global_processing_status = "Geminiモデルが手書き文字を解析中です (候補1・2を同時に生成中)..."
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            future1 = executor.submit(get_gemini_response, image_bytes, PROMPT_BASE)
+            future2 = executor.submit(get_gemini_response, image_bytes, PROMPT_VARIANT)
+            response1_text = future1.result()
+            response2_text = future2.result()
+
         logging.info(f"候補1の結果: '{response1_text}'")
         if "エラーが発生しました" in response1_text or "ブロックされました" in response1_text:
             raise Exception(f"候補1の生成に失敗: {response1_text}")
 
-        global_processing_status = "Geminiモデルが手書き文字を解析中です (候補2/2)..."
-        response2_text = get_gemini_response(image_bytes, PROMPT_VARIANT)
         logging.info(f"候補2の結果: '{response2_text}'")
         if "エラーが発生しました" in response2_text or "ブロックされました" in response2_text:
             raise Exception(f"候補2の生成に失敗: {response2_text}")